@@ -4,6 +4,16 @@ import re
 import json
 import logging
 import argparse
+import yaml
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 # Constants
 PRICE_FIELDS = [
@@ -18,6 +28,10 @@ TEXT_FIELDS = [
 
 PLACEHOLDER_VALUE = "999999999"
 
+# pandas' default NA strings; these cells are read as blanks, as they were with pd.read_csv
+NULL_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+               "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
 def apply_conditional_rules(df):
     violations = {}
     mask1 = df[PRICE_FIELDS[:3]].notna().any(axis=1) & (~df[["insurance payer name", "insurance plan name", "negotiated methodology"]].notna().all(axis=1))
@@ -53,8 +67,98 @@ def apply_conditional_rules(df):
     violations['rule_10'] = mask10
     return violations
 
-def load_registry_info(campus_id, registry_path):
+@lru_cache(maxsize=8)
+def _read_registry(registry_path, registry_mtime):
+    # Parquet sibling of the Excel registry; reused while it is newer than the workbook
+    cache_path = registry_path + ".parquet"
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= registry_mtime:
+        try:
+            return pd.read_parquet(cache_path)
+        except (ValueError, OSError) as e:
+            logging.warning(f"Could not read registry cache '{cache_path}': {e}")
+
     df = pd.read_excel(registry_path, sheet_name="Sheet1")
+    try:
+        df.to_parquet(cache_path, index=False)
+    except (ValueError, TypeError, OSError) as e:
+        logging.warning(f"Could not write registry cache '{cache_path}': {e}")
+    return df
+
+def load_registry_df(registry_path):
+    # Shared by the extractors so the registry cache lives in one place
+    return _read_registry(registry_path, os.path.getmtime(registry_path))
+
+@lru_cache(maxsize=8)
+def _read_config(config_path, config_mtime):
+    with open(config_path, "r") as f:
+        return yaml.load(f, Loader=YamlLoader)
+
+def load_config(config_path):
+    # Cached and shared, so callers copy what they keep instead of mutating it
+    return _read_config(config_path, os.path.getmtime(config_path))
+
+def _run_campus(task):
+    extract, campus_id, metadata, registry_path, config_path, base_dir, options = task
+    try:
+        extract(campus_id, registry_path, config_path, base_dir, metadata=metadata, **options)
+        return campus_id, True
+    except Exception:
+        logging.exception(f"Failed to extract campus '{campus_id}'")
+        return campus_id, False
+
+def batch_extract(extract, load_info, campus_ids, registry_path, config_path, base_dir, workers=None, **options):
+    # Registry is read once here; each worker receives its campus metadata with the task.
+    # Repeated IDs run once so two workers never write the same output files.
+    campus_ids = list(dict.fromkeys(campus_ids))
+    results = {}
+    tasks = []
+    for campus_id in campus_ids:
+        try:
+            metadata = load_info(campus_id, registry_path)
+        except Exception:
+            logging.exception(f"Failed to look up campus '{campus_id}' in the registry")
+            results[campus_id] = False
+            continue
+        tasks.append((extract, campus_id, metadata, registry_path, config_path, base_dir, options))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results.update(pool.map(_run_campus, tasks))
+    return {campus_id: results[campus_id] for campus_id in campus_ids}
+
+def read_mrf_csv_chunks(raw_path, header_lines, column_names, read_columns, fallback_chunksize=50000):
+    # Data rows of a CSV MRF as all-string DataFrames holding read_columns (absent ones blank).
+    # header_lines counts physical lines, so quoted newlines in the metadata rows are covered.
+    read_options = pacsv.ReadOptions(skip_rows=header_lines, column_names=column_names, block_size=8 << 20)
+    parse_options = pacsv.ParseOptions(newlines_in_values=True)
+    convert_options = pacsv.ConvertOptions(
+        column_types={col: pa.string() for col in read_columns},
+        null_values=NULL_VALUES,
+        strings_can_be_null=True,
+        include_columns=read_columns,
+        include_missing_columns=True
+    )
+    rows_read = 0
+    try:
+        for batch in pacsv.open_csv(raw_path, read_options=read_options, parse_options=parse_options,
+                                    convert_options=convert_options):
+            rows_read += batch.num_rows
+            yield batch.to_pandas().fillna("")
+        return
+    except pa.ArrowInvalid as e:
+        logging.warning(f"Arrow could not read '{raw_path}' after {rows_read:,} rows ({e}); continuing with pandas")
+
+    # pandas pads short rows with blanks; rows already produced by Arrow are skipped
+    wanted = set(read_columns)
+    for chunk in pd.read_csv(raw_path, skiprows=2, dtype=str, chunksize=fallback_chunksize,
+                             usecols=lambda col: col in wanted, low_memory=False):
+        if rows_read >= len(chunk):
+            rows_read -= len(chunk)
+            continue
+        chunk = chunk.iloc[rows_read:]
+        rows_read = 0
+        yield chunk.reindex(columns=read_columns).fillna("")
+
+def load_registry_info(campus_id, registry_path):
+    df = load_registry_df(registry_path)
     row = df[df["campus_id"] == campus_id]
     if row.empty:
         raise ValueError(f"Campus ID '{campus_id}' not found in hospital registry.")
@@ -1,13 +1,16 @@
-import ijson
 import csv
+from array import array
 import argparse
 import os
 import re
 import logging
 import json
-import yaml
-import pandas as pd
+import codecs
+import simdjson
 from collections import defaultdict
+from dataclasses import dataclass, field
+
+from cleaning_utils import batch_extract, load_config, load_registry_df
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
 
@@ -19,15 +22,20 @@ HEADERS = [
     "setting", "additional notes"
 ]
 
-UNKNOWN_CODE_TYPES = defaultdict(int)
-FIELD_PRESENCE_LOG = defaultdict(int)
-CODE_TYPE_PRESENCE = defaultdict(int)
-CODE_TYPE_MAPPINGS_USED = defaultdict(set)
-MODIFIER_COUNTS = defaultdict(int)
+@dataclass
+class RunStats:
+    # Counters for one extraction run, reported in the devlog
+    unknown_code_types: dict = field(default_factory=lambda: defaultdict(int))
+    field_presence: array = field(default_factory=lambda: array('q', [0]) * len(HEADERS))
+    code_type_presence: dict = field(default_factory=lambda: defaultdict(int))
+    code_type_mappings_used: dict = field(default_factory=lambda: defaultdict(set))
+    modifier_counts: dict = field(default_factory=lambda: defaultdict(int))
+
+WRITE_BATCH_SIZE = 8192
 
 
 def load_registry_info(campus_id, registry_path):
-    df = pd.read_excel(registry_path, sheet_name="Sheet1")
+    df = load_registry_df(registry_path)
     row = df[df["campus_id"] == campus_id]
     if row.empty:
         raise ValueError(f"Campus ID '{campus_id}' not found in hospital registry.")
@@ -41,18 +49,53 @@ def load_registry_info(campus_id, registry_path):
 
 
 def load_extract_config(config_path):
-    with open(config_path, "r") as f:
-        config = yaml.safe_load(f)
+    config = load_config(config_path)
     extract_config = config.get("extract", {})
     return (
         set(extract_config.get("allowed_code_types", [])),
-        extract_config.get("code_type_normalization", {})
+        dict(extract_config.get("code_type_normalization", {}))
     )
 
 
-def parse_json(campus_id, registry_path, config_path, base_dir):
-    metadata = load_registry_info(campus_id, registry_path)
+def load_mrf_root(raw_path, use_stdlib_json=False):
+    with open(raw_path, 'rb') as f:
+        raw_bytes = f.read()
+    # utf-8-sig files carry a BOM that the strict parsers reject
+    bom_len = len(codecs.BOM_UTF8) if raw_bytes.startswith(codecs.BOM_UTF8) else 0
+    data = memoryview(raw_bytes)[bom_len:]
+
+    if not use_stdlib_json:
+        try:
+            # simdjson returns lazy Object/Array views; nested dicts are only materialized when accessed
+            return simdjson.Parser().parse(data)
+        except ValueError as e:
+            logging.warning(f" simdjson could not parse '{raw_path}' ({e}); falling back to json")
+
+    # json keeps the last value for duplicate keys (simdjson keeps the first) and accepts NaN literals
+    return json.loads(bytes(data))
+
+
+def first_item(value):
+    if isinstance(value, (list, simdjson.Array)):
+        return to_python(value[0]) if value else None
+    return to_python(value)
+
+
+def to_python(value):
+    # Missing-key lookups on simdjson views cost far more than on dicts, so records are
+    # materialized once before their optional fields are read
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
+
+
+def parse_json(campus_id, registry_path, config_path, base_dir, use_stdlib_json=False, metadata=None):
+    if metadata is None:
+        metadata = load_registry_info(campus_id, registry_path)
     allowed_code_types, code_type_map = load_extract_config(config_path)
+    stats = RunStats()
 
     system = metadata["healthcare_system"].lower()
     raw_path = os.path.join(base_dir, "data", "raw data", f"{system}", metadata["raw_filename"])
@@ -66,28 +109,33 @@ def parse_json(campus_id, registry_path, config_path, base_dir):
     dev_log_path = os.path.join(devlog_dir, f"{campus_id}_devlog.json")
 
     with open(output_path, 'w', newline='', encoding='utf-8') as out_csv:
-        writer = csv.DictWriter(out_csv, fieldnames=HEADERS)
-        writer.writeheader()
+        writer = csv.writer(out_csv)
+        writer.writerow(HEADERS)
 
         written = 0
-        raw_hospital_location = None
-        raw_hospital_address = None
-        raw_top_level_keys = set()
-        mrf_version = None
-        mrf_last_updated = None
-
-        with open(raw_path, 'r', encoding='utf-8-sig') as f:
-            parser = ijson.parse(f)
-            for prefix, event, value in parser:
-                if prefix == 'hospital_location.item' and event == 'string':
-                    raw_hospital_location = value
-                if prefix == 'hospital_address.item' and event == 'string':
-                    raw_hospital_address = value
-                if raw_hospital_location and raw_hospital_address:
-                    break
-
-        with open(raw_path, 'r', encoding='utf-8-sig') as f:
-            root = json.load(f)
+        buf = []
+        # Local aliases keep the per-record increments off attribute lookups
+        field_presence = stats.field_presence
+        unknown_code_types = stats.unknown_code_types
+        code_type_presence = stats.code_type_presence
+        code_type_mappings_used = stats.code_type_mappings_used
+        modifier_counts = stats.modifier_counts
+
+        def flush_rows():
+            for row in buf:
+                for i, value in enumerate(row):
+                    if value:
+                        field_presence[i] += 1
+            writer.writerows(buf)
+            buf.clear()
+
+        hospital_name = metadata["hospital_name"]
+        zip_code = metadata["zip_code"]
+
+        root = load_mrf_root(raw_path, use_stdlib_json)
+
+        raw_hospital_location = first_item(root.get("hospital_location"))
+        raw_hospital_address = first_item(root.get("hospital_address"))
 
         raw_top_level_keys = set(root.keys())
         known_keys_used = {"standard_charge_information", "hospital_location", "hospital_address", "modifier_information"}
@@ -96,14 +144,15 @@ def parse_json(campus_id, registry_path, config_path, base_dir):
         mrf_last_updated = root.get("last_updated_on")
 
         sci = root.get("standard_charge_information", [])
-        if isinstance(sci, dict):
+        if isinstance(sci, (dict, simdjson.Object)):
             items = sci.get("item", [])
-        elif isinstance(sci, list):
+        elif isinstance(sci, (list, simdjson.Array)):
             items = sci
         else:
             items = []
 
         for item in items:
+            item = to_python(item)
             description = item.get("description", "")
             code_info = item.get("code_information", [])
             charge_entries = item.get("standard_charges", [])
@@ -114,13 +163,13 @@ def parse_json(campus_id, registry_path, config_path, base_dir):
             for code_entry in code_info:
                 raw_code_type = str(code_entry.get("type", "")).strip().upper()
                 normalized_code_type = code_type_map.get(raw_code_type)
-                CODE_TYPE_MAPPINGS_USED[raw_code_type].add(normalized_code_type)
+                code_type_mappings_used[raw_code_type].add(normalized_code_type)
 
                 if normalized_code_type not in allowed_code_types:
-                    UNKNOWN_CODE_TYPES[raw_code_type] += 1
+                    unknown_code_types[raw_code_type] += 1
                     continue
 
-                CODE_TYPE_PRESENCE[normalized_code_type] += 1
+                code_type_presence[normalized_code_type] += 1
                 has_valid_code = True
                 code = code_entry.get("code", "")
 
@@ -138,70 +187,51 @@ def parse_json(campus_id, registry_path, config_path, base_dir):
                         negotiated_algorithm = payer.get("standard_charge_algorithm", "")
                         negotiated_methodology = payer.get("negotiated_methodology", "")
 
-                        row = {
-                            "hospital name": metadata["hospital_name"],
-                            "zip code": metadata["zip_code"],
-                            "code": code,
-                            "code type": normalized_code_type,
-                            "description": description,
-                            "drug unit": drug_info.get("unit", ""),
-                            "drug type": drug_info.get("type", ""),
-                            "insurance payer name": payer.get("payer_name", ""),
-                            "insurance payer id": payer.get("payer_id", ""),
-                            "insurance plan name": payer.get("plan_name", ""),
-                            "negotiated price": negotiated_price,
-                            "negotiated percentage": negotiated_percentage,
-                            "negotiated algorithm": negotiated_algorithm,
-                            "negotiated methodology": negotiated_methodology,
-                            "gross charge": gross_charge,
-                            "discounted cash price": discounted_cash,
-                            "min price": min_price,
-                            "max price": max_price,
-                            "estimated amount": estimated_amount,
-                            "setting": setting,
-                            "additional notes": payer.get("additional_payer_notes", "")
-                        }
-
-                        for key in HEADERS:
-                            if row.get(key):
-                                FIELD_PRESENCE_LOG[key] += 1
-
-                        writer.writerow(row)
+                        # Columns follow HEADERS order
+                        buf.append((
+                            hospital_name,
+                            zip_code,
+                            code,
+                            normalized_code_type,
+                            description,
+                            drug_info.get("unit", ""),
+                            drug_info.get("type", ""),
+                            payer.get("payer_name", ""),
+                            payer.get("payer_id", ""),
+                            payer.get("plan_name", ""),
+                            negotiated_price,
+                            negotiated_percentage,
+                            negotiated_algorithm,
+                            negotiated_methodology,
+                            gross_charge,
+                            discounted_cash,
+                            min_price,
+                            max_price,
+                            estimated_amount,
+                            setting,
+                            payer.get("additional_payer_notes", "")
+                        ))
                         written += 1
+                        if len(buf) >= WRITE_BATCH_SIZE:
+                            flush_rows()
 
         # Modifier-only records (standalone, outside standard_charge_information)
         for mod in root.get("modifier_information", []):
+            mod = to_python(mod)
             mod_code = mod.get("code", "")
             mod_desc = mod.get("description", "")
-            MODIFIER_COUNTS[mod_code] += 1
+            modifier_counts[mod_code] += 1
             for payer in mod.get("modifier_payer_information", []):
-                row = {
-                    "hospital name": metadata["hospital_name"],
-                    "zip code": metadata["zip_code"],
-                    "code": mod_code,
-                    "code type": "MODIFIER",
-                    "description": mod_desc,
-                    "insurance payer name": payer.get("payer_name", ""),
-                    "insurance payer id": "",
-                    "insurance plan name": payer.get("plan_name", ""),
-                    "negotiated price": "",
-                    "negotiated percentage": "",
-                    "negotiated algorithm": "",
-                    "negotiated methodology": "",
-                    "gross charge": "",
-                    "discounted cash price": "",
-                    "min price": "",
-                    "max price": "",
-                    "estimated amount": "",
-                    "setting": "",
-                    "additional notes": payer.get("description", "")
-                }
-                for key in HEADERS:
-                    if row.get(key):
-                        FIELD_PRESENCE_LOG[key] += 1
-                writer.writerow(row)
+                buf.append((
+                    hospital_name, zip_code, mod_code, "MODIFIER", mod_desc, "", "",
+                    payer.get("payer_name", ""), "", payer.get("plan_name", ""),
+                    "", "", "", "", "", "", "", "", "", "",
+                    payer.get("description", "")
+                ))
                 written += 1
 
+        flush_rows()
+
     if written == 0:
         logging.warning(" No valid records found for allowed code types.")
     else:
@@ -209,8 +239,8 @@ def parse_json(campus_id, registry_path, config_path, base_dir):
         logging.info(f" Parsing done. Extracted {written:,} records into '{output_path}' with size: {size_mb:.2f} MB")
 
     # Ensure every field in HEADERS has a count (even 0)
-    full_field_summary = {field: FIELD_PRESENCE_LOG.get(field, 0) for field in HEADERS}
-    missing_code_types = [ct for ct in allowed_code_types if CODE_TYPE_PRESENCE[ct] == 0]
+    full_field_summary = dict(zip(HEADERS, field_presence))
+    missing_code_types = [ct for ct in allowed_code_types if code_type_presence[ct] == 0]
 
     with open(dev_log_path, "w") as log_file:
         json.dump({
@@ -223,28 +253,43 @@ def parse_json(campus_id, registry_path, config_path, base_dir):
                 "last_updated_on": mrf_last_updated
             },
             "field_presence_summary": full_field_summary,
-            "unrecognized_code_types": dict(UNKNOWN_CODE_TYPES),
+            "unrecognized_code_types": dict(unknown_code_types),
             "missing_code_types": missing_code_types,
-            "code_type_presence": dict(CODE_TYPE_PRESENCE),
-            "code_type_normalizations_used": {k: list(v) for k, v in CODE_TYPE_MAPPINGS_USED.items()},
-            "modifier_counts": dict(MODIFIER_COUNTS),
+            "code_type_presence": dict(code_type_presence),
+            "code_type_normalizations_used": {k: list(v) for k, v in code_type_mappings_used.items()},
+            "modifier_counts": dict(modifier_counts),
             "unused_optional_json_keys": sorted(list(raw_top_level_keys - known_keys_used)),
         }, log_file, indent=2)
     logging.info(f" Dev log saved to: {dev_log_path }")
 
 
+def batch_parse(campus_ids, registry_path, config_path, base_dir, workers=None, use_stdlib_json=False):
+    return batch_extract(parse_json, load_registry_info, campus_ids, registry_path, config_path, base_dir,
+                         workers=workers, use_stdlib_json=use_stdlib_json)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Clearcare JSON Parser")
-    parser.add_argument("--campus_id", required=True, help="Campus ID as per Hospital Registry")
+    parser.add_argument("--campus_id", required=True, nargs="+", help="Campus ID(s) as per Hospital Registry")
     parser.add_argument("--registry", default="Hospital Registry.xlsx", help="Path to hospital registry Excel file")
     parser.add_argument("--config", default="utils/config.yaml", help="Path to config YAML file")
     parser.add_argument("--base_dir", default=".", help="Base directory of Clearcare project")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes when several campus IDs are given")
+    parser.add_argument("--stdlib_json", action="store_true", help="Parse with the json module, e.g. for files with duplicate keys")
 
     args = parser.parse_args()
 
-    parse_json(
-        campus_id=args.campus_id,
-        registry_path=args.registry,
-        config_path=args.config,
-        base_dir=args.base_dir
-    )
+    if len(args.campus_id) == 1:
+        parse_json(
+            campus_id=args.campus_id[0],
+            registry_path=args.registry,
+            config_path=args.config,
+            base_dir=args.base_dir,
+            use_stdlib_json=args.stdlib_json
+        )
+    else:
+        results = batch_parse(args.campus_id, args.registry, args.config, args.base_dir, workers=args.workers, use_stdlib_json=args.stdlib_json)
+        failed = [campus_id for campus_id, ok in results.items() if not ok]
+        if failed:
+            logging.warning(f" Failed campuses: {', '.join(failed)}")
+        logging.info(f" Batch done: {len(results) - len(failed)}/{len(results)} campuses extracted")
@@ -2,11 +2,16 @@ import pandas as pd
 import os
 import argparse
 import json
+import csv
 import re
 import logging
-import yaml
 from collections import defaultdict
+from dataclasses import dataclass, field
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from cleaning_utils import batch_extract, load_config, load_registry_df, read_mrf_csv_chunks
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
 
@@ -18,14 +23,62 @@ HEADERS = [
     "setting", "additional notes", "modifiers"
 ]
 
-UNKNOWN_CODE_TYPES = defaultdict(int)
-FIELD_PRESENCE_LOG = defaultdict(int)
-CODE_TYPE_PRESENCE = defaultdict(int)
-CODE_TYPE_MAPPINGS_USED = defaultdict(set)
-MODIFIER_COUNTS = defaultdict(int)
+# Same value on every row of a file; written as dictionary-encoded columns so the string is stored once
+CONSTANT_HEADERS = ["hospital name", "zip code"]
+ROW_HEADERS = [header for header in HEADERS if header not in CONSTANT_HEADERS]
+
+OUTPUT_SCHEMA = pa.schema([
+    (header, pa.dictionary(pa.int8(), pa.string()) if header in CONSTANT_HEADERS else pa.string())
+    for header in HEADERS
+])
+
+ROW_FIELD_COLUMNS = {
+    "description": "description",
+    "drug unit": "drug_unit_of_measurement",
+    "drug type": "drug_type_of_measurement",
+    "insurance plan name": "plan_name",
+    "negotiated price": "standard_charge|negotiated_dollar",
+    "negotiated percentage": "standard_charge|negotiated_percentage",
+    "negotiated algorithm": "standard_charge|negotiated_algorithm",
+    "negotiated methodology": "standard_charge|methodology",
+    "gross charge": "standard_charge|gross",
+    "discounted cash price": "standard_charge|discounted_cash",
+    "min price": "standard_charge|min",
+    "max price": "standard_charge|max",
+    "estimated amount": "estimated_amount",
+    "setting": "setting",
+    "additional notes": "additional_generic_notes"
+}
+
+CODE_COLUMNS = [(f"code|{i}", f"code|{i}|type") for i in range(1, 5)]
+
+RAW_COLUMNS = ["payer_name", "modifiers", *ROW_FIELD_COLUMNS.values(), *(col for pair in CODE_COLUMNS for col in pair)]
+
+PAYER_RE = re.compile(r"(.*)\[(.*?)\]")
+MOD_TRANS = str.maketrans({"|": ","})
+
+HEADER_INDEX = {header: i for i, header in enumerate(HEADERS)}
+ROW_HEADER_INDEX = [HEADER_INDEX[header] for header in ROW_HEADERS]
+
+@dataclass
+class RunStats:
+    # Counters for one extraction run, reported in the devlog; code_type_presence is indexed
+    # by position in the run's sorted allowed code types
+    code_type_presence: np.ndarray
+    unknown_code_types: dict = field(default_factory=lambda: defaultdict(int))
+    field_presence: np.ndarray = field(default_factory=lambda: np.zeros(len(HEADERS), dtype=np.int64))
+    code_type_mappings_used: dict = field(default_factory=lambda: defaultdict(set))
+    modifier_counts: dict = field(default_factory=lambda: defaultdict(int))
+
+def add_counts(counter, counts):
+    for key, count in counts.items():
+        counter[key] += int(count)
+
+def constant_column(value, length):
+    return pa.DictionaryArray.from_arrays(pa.array(np.zeros(length, dtype=np.int8)), pa.array([value], type=pa.string()))
 
 def load_registry_info(campus_id, registry_path):
-    df = pd.read_excel(registry_path, sheet_name="Sheet1")
+    df = load_registry_df(registry_path)
     row = df[df["campus_id"] == campus_id]
     if row.empty:
         raise ValueError(f"Campus ID '{campus_id}' not found in hospital registry.")
@@ -38,17 +91,19 @@ def load_registry_info(campus_id, registry_path):
     }
 
 def load_extract_config(config_path):
-    with open(config_path, "r") as f:
-        config = yaml.safe_load(f)
+    config = load_config(config_path)
     extract_config = config.get("extract", {})
     return (
         set(extract_config.get("allowed_code_types", [])),
-        extract_config.get("code_type_normalization", {}),
+        dict(extract_config.get("code_type_normalization", {})),
     )
 
-def extract_tall_format_csv(campus_id, registry_path, config_path, base_dir):
-    metadata = load_registry_info(campus_id, registry_path)
+def extract_tall_format_csv(campus_id, registry_path, config_path, base_dir, metadata=None):
+    if metadata is None:
+        metadata = load_registry_info(campus_id, registry_path)
     allowed_code_types, code_type_map = load_extract_config(config_path)
+    code_type_dtype = pd.CategoricalDtype(categories=sorted(allowed_code_types))
+    stats = RunStats(code_type_presence=np.zeros(len(code_type_dtype.categories), dtype=np.int64))
 
     system = metadata["healthcare_system"].lower()
     raw_path = os.path.join(base_dir, "data", "raw data", f"{system}", metadata["raw_filename"])
@@ -63,92 +118,89 @@ def extract_tall_format_csv(campus_id, registry_path, config_path, base_dir):
 
     written = 0
 
-    metadata_df = pd.read_csv(raw_path, nrows=2, header=None).fillna("")
-    mrf_metadata_dict = dict(zip(metadata_df.iloc[0], metadata_df.iloc[1]))
+    with open(raw_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        metadata_keys = next(reader, [])
+        metadata_values = next(reader, [])
+        column_names = next(reader, [])
+        header_lines = reader.line_num
+    mrf_metadata_dict = dict(zip(metadata_keys, metadata_values))
     mrf_version = mrf_metadata_dict.get("version", "")
     mrf_last_updated = mrf_metadata_dict.get("last_updated_on", "")
     raw_hospital_location = mrf_metadata_dict.get("hospital_location", "")
     raw_hospital_address = mrf_metadata_dict.get("hospital_address", "")
 
-    with open(output_path, 'w', newline='', encoding='utf-8') as out_csv:
-        out_csv.write(",".join(HEADERS) + "\n")
-
-        for chunk in pd.read_csv(raw_path, skiprows=2, chunksize=100000, dtype=str, low_memory=False):
-            chunk = chunk.replace(np.nan, "", regex=True)
-
-            for _, row in chunk.iterrows():
-                payer_key = "payer_name"
-                payer = row.get(payer_key, "")
-
-                payer_name, payer_id = payer, ""
-                if match := re.search(r"(.*)\[(.*?)\]", payer):
-                    payer_name = match.group(1).strip()
-                    payer_id = match.group(2).strip()
-
-                notes_key = "additional_generic_notes"
-                notes = row.get(notes_key, "")
-
-                modifiers_key = "modifiers"
-                modifiers_raw = row.get(modifiers_key, "").strip()
-                modifier_list = [m.strip() for m in re.split(r"[,|]", modifiers_raw) if m.strip()]
-                for m in modifier_list:
-                    MODIFIER_COUNTS[m] += 1
-
-                for i in range(1, 5):
-                    code_col = f"code|{i}"
-                    type_col = f"code|{i}|type"
-
-                    code = row.get(code_col, "").strip()
-                    raw_code_type = row.get(type_col, "").strip().upper()
-                    if not code or not raw_code_type:
-                        continue
-
-                    normalized_code_type = code_type_map.get(raw_code_type)
-                    CODE_TYPE_MAPPINGS_USED[raw_code_type].add(normalized_code_type)
-
-                    if normalized_code_type not in allowed_code_types:
-                        UNKNOWN_CODE_TYPES[raw_code_type] += 1
-                        continue
-
-                    CODE_TYPE_PRESENCE[normalized_code_type] += 1
-
-                    output_row = {
-                        "hospital name": metadata["hospital_name"],
-                        "zip code": metadata["zip_code"],
-                        "code": code,
-                        "code type": normalized_code_type,
-                        "description": row.get("description", ""),
-                        "drug unit": row.get("drug_unit_of_measurement", ""),
-                        "drug type": row.get("drug_type_of_measurement", ""),
-                        "insurance payer name": payer_name,
-                        "insurance payer id": payer_id,
-                        "insurance plan name": row.get("plan_name", ""),
-                        "negotiated price": row.get("standard_charge|negotiated_dollar", ""),
-                        "negotiated percentage": row.get("standard_charge|negotiated_percentage", ""),
-                        "negotiated algorithm": row.get("standard_charge|negotiated_algorithm", ""),
-                        "negotiated methodology": row.get("standard_charge|methodology", ""),
-                        "gross charge": row.get("standard_charge|gross", ""),
-                        "discounted cash price": row.get("standard_charge|discounted_cash", ""),
-                        "min price": row.get("standard_charge|min", ""),
-                        "max price": row.get("standard_charge|max", ""),
-                        "estimated amount": row.get("estimated_amount", ""),
-                        "setting": row.get("setting", ""),
-                        "additional notes": notes,
-                        "modifiers": modifiers_raw
-                    }
-
-                    for key in HEADERS:
-                        if output_row.get(key):
-                            FIELD_PRESENCE_LOG[key] += 1
-
-                    out_csv.write(",".join([f'"{output_row.get(col, "").replace("\"", "''")}"' for col in HEADERS]) + "\n")
-                    written += 1
+    constant_values = {"hospital name": metadata["hospital_name"], "zip code": metadata["zip_code"]}
+
+    with pacsv.CSVWriter(output_path, OUTPUT_SCHEMA) as writer:
+
+        for chunk in read_mrf_csv_chunks(raw_path, header_lines, column_names, RAW_COLUMNS, fallback_chunksize=100000):
+
+            payer = chunk["payer_name"]
+            payer_parts = payer.str.extract(PAYER_RE)
+            payer_name = payer_parts[0].str.strip().where(payer_parts[0].notna(), payer)
+            payer_id = payer_parts[1].str.strip().fillna("")
+
+            modifiers_raw = chunk["modifiers"].str.strip()
+            modifier_list = modifiers_raw.str.translate(MOD_TRANS).str.split(",").explode().str.strip()
+            add_counts(stats.modifier_counts, modifier_list[modifier_list != ""].value_counts())
+
+            row_fields = pd.DataFrame({
+                **{header: chunk[col] for header, col in ROW_FIELD_COLUMNS.items()},
+                "insurance payer name": payer_name,
+                "insurance payer id": payer_id,
+                "modifiers": modifiers_raw
+            }, index=chunk.index)
+
+            # Normalize each distinct raw type string once; cells are then resolved by a single dict lookup
+            raw_types = pd.unique(pd.concat([chunk[type_col] for _, type_col in CODE_COLUMNS]))
+            canonical_types = {raw: raw.strip().upper() for raw in raw_types}
+            normalized_types = {raw: code_type_map.get(canonical) for raw, canonical in canonical_types.items()}
+
+            code_frames = []
+            for code_col, type_col in CODE_COLUMNS:
+                code = chunk[code_col].str.strip()
+                raw_code_type = chunk[type_col].map(canonical_types)
+                present = (code != "") & (raw_code_type != "")
+                code, raw_code_type = code[present], raw_code_type[present]
+
+                normalized_code_type = chunk.loc[present, type_col].map(normalized_types)
+                mappings = pd.DataFrame({"raw": raw_code_type, "normalized": normalized_code_type}).drop_duplicates()
+                for raw, normalized in mappings.itertuples(index=False):
+                    stats.code_type_mappings_used[raw].add(normalized if pd.notna(normalized) else None)
+
+                # Types outside the allowed categories encode as -1
+                type_codes = pd.Categorical(normalized_code_type, dtype=code_type_dtype).codes
+                allowed = type_codes >= 0
+                add_counts(stats.unknown_code_types, raw_code_type[~allowed].value_counts())
+                stats.code_type_presence += np.bincount(type_codes[allowed], minlength=len(code_type_dtype.categories))
+
+                code_frames.append(pd.DataFrame({"code": code[allowed], "code type": normalized_code_type[allowed]}))
+
+            # Stable sort restores the original row-major order (row, then code|1..4)
+            codes = pd.concat(code_frames).sort_index(kind="stable")
+            out_df = row_fields.loc[codes.index]
+            out_df[["code", "code type"]] = codes.to_numpy()
+            out_df = out_df[ROW_HEADERS]
+
+            for header, value in constant_values.items():
+                if value:
+                    stats.field_presence[HEADER_INDEX[header]] += len(out_df)
+            stats.field_presence[ROW_HEADER_INDEX] += (out_df.to_numpy() != "").sum(axis=0)
+
+            writer.write_table(pa.Table.from_arrays([
+                constant_column(constant_values[header], len(out_df)) if header in constant_values
+                else pa.array(out_df[header], type=pa.string())
+                for header in HEADERS
+            ], schema=OUTPUT_SCHEMA))
+            written += len(out_df)
 
     size_mb = os.path.getsize(output_path) / 1024 / 1024
     logging.info(f" Parsing done. Extracted {written:,} records into '{output_path}' with size: {size_mb:.2f} MB")
 
-    full_field_summary = {field: FIELD_PRESENCE_LOG.get(field, 0) for field in HEADERS}
-    missing_code_types = [ct for ct in allowed_code_types if CODE_TYPE_PRESENCE[ct] == 0]
+    full_field_summary = {header: int(stats.field_presence[i]) for header, i in HEADER_INDEX.items()}
+    code_type_presence = dict(zip(code_type_dtype.categories, stats.code_type_presence.tolist()))
+    missing_code_types = [ct for ct, count in code_type_presence.items() if count == 0]
 
     with open(dev_log_path, "w") as log_file:
         json.dump({
@@ -161,25 +213,37 @@ def extract_tall_format_csv(campus_id, registry_path, config_path, base_dir):
                 "last_updated_on": mrf_last_updated
             },
             "field_presence_summary": full_field_summary,
-            "unrecognized_code_types": dict(UNKNOWN_CODE_TYPES),
+            "unrecognized_code_types": dict(stats.unknown_code_types),
             "missing_code_types": missing_code_types,
-            "code_type_presence": dict(CODE_TYPE_PRESENCE),
-            "code_type_normalizations_used": {k: list(v) for k, v in CODE_TYPE_MAPPINGS_USED.items()},
-            "modifier_counts": dict(MODIFIER_COUNTS),
+            "code_type_presence": code_type_presence,
+            "code_type_normalizations_used": {k: list(v) for k, v in stats.code_type_mappings_used.items()},
+            "modifier_counts": dict(stats.modifier_counts),
         }, log_file, indent=2)
     logging.info(f" Dev log saved to: {dev_log_path}")
 
+def batch_parse(campus_ids, registry_path, config_path, base_dir, workers=None):
+    return batch_extract(extract_tall_format_csv, load_registry_info, campus_ids, registry_path, config_path, base_dir,
+                         workers=workers)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Clearcare Tall Format CSV Extractor")
-    parser.add_argument("--campus_id", required=True, help="Campus ID as per Hospital Registry")
+    parser.add_argument("--campus_id", required=True, nargs="+", help="Campus ID(s) as per Hospital Registry")
     parser.add_argument("--registry", default="Hospital Registry.xlsx", help="Path to hospital registry Excel file")
     parser.add_argument("--config", default="utils/config.yaml", help="Path to config YAML file")
     parser.add_argument("--base_dir", default=".", help="Base directory of Clearcare project")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes when several campus IDs are given")
     args = parser.parse_args()
 
-    extract_tall_format_csv(
-        campus_id=args.campus_id,
-        registry_path=args.registry,
-        config_path=args.config,
-        base_dir=args.base_dir
-    )
+    if len(args.campus_id) == 1:
+        extract_tall_format_csv(
+            campus_id=args.campus_id[0],
+            registry_path=args.registry,
+            config_path=args.config,
+            base_dir=args.base_dir
+        )
+    else:
+        results = batch_parse(args.campus_id, args.registry, args.config, args.base_dir, workers=args.workers)
+        failed = [campus_id for campus_id, ok in results.items() if not ok]
+        if failed:
+            logging.warning(f" Failed campuses: {', '.join(failed)}")
+        logging.info(f" Batch done: {len(results) - len(failed)}/{len(results)} campuses extracted")
@@ -2,10 +2,16 @@ import pandas as pd
 import os
 import argparse
 import json
-import re
+import csv
 import logging
-import yaml
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from contextlib import ExitStack
 from collections import defaultdict
+from dataclasses import dataclass, field
+
+from cleaning_utils import batch_extract, load_config, load_registry_df, read_mrf_csv_chunks
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
 
@@ -26,14 +32,44 @@ STANDARD_CHARGE_PREFIXES = {
     "additional_payer_notes": "additional notes"
 }
 
-UNKNOWN_CODE_TYPES = defaultdict(int)
-FIELD_PRESENCE_LOG = defaultdict(int)
-CODE_TYPE_PRESENCE = defaultdict(int)
-CODE_TYPE_MAPPINGS_USED = defaultdict(set)
-MODIFIER_COUNTS = defaultdict(int)
+ROW_FIELD_COLUMNS = {
+    "description": "description",
+    "drug unit": "drug_unit_of_measurement",
+    "drug type": "drug_type_of_measurement",
+    "gross charge": "standard_charge|gross",
+    "discounted cash price": "standard_charge|discounted_cash",
+    "min price": "standard_charge|min",
+    "max price": "standard_charge|max",
+    "setting": "setting"
+}
+
+CODE_COLUMNS = [(f"code|{i}", f"code|{i}|type") for i in range(1, 5)]
+
+RAW_COLUMNS = ["additional_generic_notes", "modifiers", *ROW_FIELD_COLUMNS.values(), *(col for pair in CODE_COLUMNS for col in pair)]
+
+MOD_TRANS = str.maketrans({"|": ","})
+
+HEADER_INDEX = {header: i for i, header in enumerate(HEADERS)}
+
+OUTPUT_FORMATS = ["csv", "parquet", "both"]
+PARQUET_SCHEMA = pa.schema([(header, pa.string()) for header in HEADERS])
+
+@dataclass
+class RunStats:
+    # Counters for one extraction run, reported in the devlog; code_type_presence is indexed
+    # by position in the run's sorted allowed code types
+    code_type_presence: np.ndarray
+    unknown_code_types: dict = field(default_factory=lambda: defaultdict(int))
+    field_presence: np.ndarray = field(default_factory=lambda: np.zeros(len(HEADERS), dtype=np.int64))
+    code_type_mappings_used: dict = field(default_factory=lambda: defaultdict(set))
+    modifier_counts: dict = field(default_factory=lambda: defaultdict(int))
+
+def add_counts(counter, counts):
+    for key, count in counts.items():
+        counter[key] += int(count)
 
 def load_registry_info(campus_id, registry_path):
-    df = pd.read_excel(registry_path, sheet_name="Sheet1")
+    df = load_registry_df(registry_path)
     row = df[df["campus_id"] == campus_id]
     if row.empty:
         raise ValueError(f"Campus ID '{campus_id}' not found in hospital registry.")
@@ -46,13 +82,12 @@ def load_registry_info(campus_id, registry_path):
     }
 
 def load_extract_config(config_path):
-    with open(config_path, "r") as f:
-        config = yaml.safe_load(f)
+    config = load_config(config_path)
     extract_config = config.get("extract", {})
-    modifier_map = config.get("modifiers", {})
+    modifier_map = dict(config.get("modifiers", {}))
     return (
         set(extract_config.get("allowed_code_types", [])),
-        extract_config.get("code_type_normalization", {}),
+        dict(extract_config.get("code_type_normalization", {})),
         modifier_map
     )
 
@@ -62,9 +97,103 @@ def parse_column_for_payer(colname):
         return None, None, None
     return parts[0], parts[1], parts[2]  # field_type, payer_name, plan_name
 
-def extract_wide_format_csv(campus_id, registry_path, config_path, base_dir):
-    metadata = load_registry_info(campus_id, registry_path)
+def classify_payer_column(colname):
+    # "field|payer|plan" or "standard_charge|payer|plan|field"; returns the mapped output field or None
+    parts = colname.split("|")
+    if len(parts) < 3:
+        return None
+    field_key = parts[0] if len(parts) == 3 else parts[-1]
+    return STANDARD_CHARGE_PREFIXES.get(field_key.strip())
+
+def reshape_wide_chunk(chunk, col_meta, metadata, code_type_dtype, code_type_map, stats):
+    for col in RAW_COLUMNS:
+        if col not in chunk:
+            chunk[col] = ""
+
+    modifier_list = chunk["modifiers"].str.translate(MOD_TRANS).str.split(",").explode().str.strip()
+    add_counts(stats.modifier_counts, modifier_list[modifier_list != ""].value_counts())
+
+    # Unpivot payer cells to (row, col, value), keeping only filled cells
+    values_long = (chunk[col_meta["col"].tolist()]
+                   .melt(var_name="col", value_name="value", ignore_index=False)
+                   .rename_axis("row").reset_index())
+    values_long = values_long[values_long["value"] != ""].merge(col_meta, on="col")
+
+    # Normalize each distinct raw type string once; cells are then resolved by a single dict lookup
+    raw_types = pd.unique(pd.concat([chunk[type_col] for _, type_col in CODE_COLUMNS]))
+    canonical_types = {raw: raw.strip().upper() for raw in raw_types}
+    normalized_types = {raw: code_type_map.get(canonical) for raw, canonical in canonical_types.items()}
+
+    code_frames = []
+    for code_pos, (code_col, type_col) in enumerate(CODE_COLUMNS):
+        code = chunk[code_col].str.strip()
+        raw_code_type = chunk[type_col].map(canonical_types)
+        present = (code != "") & (raw_code_type != "")
+        code_frames.append(pd.DataFrame({
+            "row": chunk.index[present],
+            "code_pos": code_pos,
+            "code": code[present].to_numpy(),
+            "raw_code_type": raw_code_type[present].to_numpy(),
+            "code type": chunk.loc[present, type_col].map(normalized_types).to_numpy()
+        }))
+    codes_long = pd.concat(code_frames, ignore_index=True)
+
+    # Every filled payer cell applies to every code on its row
+    pairs = values_long.merge(codes_long, on="row")
+
+    mappings = pairs[["raw_code_type", "code type"]].drop_duplicates()
+    for raw, normalized in mappings.itertuples(index=False):
+        stats.code_type_mappings_used[raw].add(normalized if pd.notna(normalized) else None)
+
+    # Types outside the allowed categories encode as -1
+    type_codes = pd.Categorical(pairs["code type"], dtype=code_type_dtype).codes
+    allowed = type_codes >= 0
+    add_counts(stats.unknown_code_types, pairs.loc[~allowed, "raw_code_type"].value_counts())
+    stats.code_type_presence += np.bincount(type_codes[allowed], minlength=len(code_type_dtype.categories))
+    pairs = pairs[allowed]
+
+    # One output record per (row, code, code type, payer, plan), numbered in order of first
+    # appearance; a later column overwrites an earlier one for the same mapped field
+    record_keys = ["row", "code", "code type", "payer", "plan"]
+    pairs = pairs.sort_values(["row", "col_pos", "code_pos"], kind="stable")
+    pairs["record"] = pairs.groupby(record_keys, sort=False).ngroup()
+    records = pairs.drop_duplicates("record").set_index("record")[record_keys]
+    fields = (pairs.drop_duplicates(["record", "mapped"], keep="last")
+              .pivot(index="record", columns="mapped", values="value")
+              .reindex(index=records.index, columns=list(STANDARD_CHARGE_PREFIXES.values()))
+              .fillna(""))
+
+    row_fields = chunk.loc[records["row"]].set_axis(records.index)
+    generic_notes = row_fields["additional_generic_notes"].str.strip()
+    payer_notes = fields["additional notes"]
+    combined_notes = (generic_notes + ", " + payer_notes).where(
+        (generic_notes != "") & (payer_notes != ""), generic_notes + payer_notes
+    )
+
+    out_df = pd.DataFrame({
+        "hospital name": metadata["hospital_name"],
+        "zip code": metadata["zip_code"],
+        "code": records["code"],
+        "code type": records["code type"],
+        **{header: row_fields[col] for header, col in ROW_FIELD_COLUMNS.items()},
+        "insurance payer name": records["payer"],
+        "insurance payer id": "",
+        "insurance plan name": records["plan"],
+        **{header: fields[header] for header in STANDARD_CHARGE_PREFIXES.values() if header != "additional notes"},
+        "additional notes": combined_notes,
+        "modifiers": row_fields["modifiers"].str.strip()
+    }, index=records.index, columns=HEADERS)
+    stats.field_presence += (out_df.to_numpy() != "").sum(axis=0)
+    return out_df
+
+def extract_wide_format_csv(campus_id, registry_path, config_path, base_dir, metadata=None, output_format="csv"):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}.")
+    if metadata is None:
+        metadata = load_registry_info(campus_id, registry_path)
     allowed_code_types, code_type_map, modifier_map = load_extract_config(config_path)
+    code_type_dtype = pd.CategoricalDtype(categories=sorted(allowed_code_types))
+    stats = RunStats(code_type_presence=np.zeros(len(code_type_dtype.categories), dtype=np.int64))
 
     system = metadata["healthcare_system"].lower()
     raw_path = os.path.join(base_dir, "data", "raw data", system, metadata["raw_filename"])
@@ -75,114 +204,67 @@ def extract_wide_format_csv(campus_id, registry_path, config_path, base_dir):
     os.makedirs(devlog_dir, exist_ok=True)
 
     output_path = os.path.join(extracted_dir, f"{campus_id}_extracted.csv")
+    parquet_path = os.path.splitext(output_path)[0] + ".parquet"
     dev_log_path = os.path.join(devlog_dir, f"{campus_id}_devlog.json")
 
-    meta_df = pd.read_csv(raw_path, nrows=2, header=None).fillna("")
-    mrf_metadata = dict(zip(meta_df.iloc[0], meta_df.iloc[1]))
+    with open(raw_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        metadata_keys = next(reader, [])
+        metadata_values = next(reader, [])
+        all_columns = next(reader, [])
+        header_lines = reader.line_num
+    mrf_metadata = dict(zip(metadata_keys, metadata_values))
     mrf_version = mrf_metadata.get("version", "")
     mrf_last_updated = mrf_metadata.get("last_updated_on", "")
     raw_hospital_location = mrf_metadata.get("hospital_location", "")
     raw_hospital_address = mrf_metadata.get("hospital_address", "")
 
-    df = pd.read_csv(raw_path, skiprows=2, dtype=str).fillna("")
-    all_columns = df.columns.tolist()
-    payer_cols = [col for col in all_columns if col.count("|") >= 2 and (
-        (col.count("|") == 2 and col.strip().split("|")[0].strip() in STANDARD_CHARGE_PREFIXES) or
-        (col.count("|") > 2 and col.strip().split("|")[-1].strip() in STANDARD_CHARGE_PREFIXES)
-    )]
-
-    rows = []
-    for _, row in df.iterrows():
-        generic_notes = row.get("additional_generic_notes", "").strip()
-        modifiers_raw = row.get("modifiers", "").strip()
-        modifier_list = [m.strip() for m in re.split(r"[,|]", modifiers_raw) if m.strip()]
-        for m in modifier_list:
-            MODIFIER_COUNTS[m] += 1
-
-        payer_row_map = defaultdict(dict)
-
-        for col in payer_cols:
-            parts = [p.strip() for p in col.split("|")]
-            if len(parts) < 3:
-                continue
-            field_key = parts[0] if len(parts) == 3 else parts[-1]
-            mapped_field = STANDARD_CHARGE_PREFIXES.get(field_key)
-            if not mapped_field:
-                continue
-
-            _, payer_name, plan_name = parse_column_for_payer(col)
-            if not payer_name:
-                continue
-            value = row[col]
-            if value == "":
-                continue
-
-            for i in range(1, 5):
-                code_col = f"code|{i}"
-                type_col = f"code|{i}|type"
-                code = row.get(code_col, "").strip()
-                raw_code_type = row.get(type_col, "").strip().upper()
-                if not code or not raw_code_type:
-                    continue
-                normalized_code_type = code_type_map.get(raw_code_type)
-                CODE_TYPE_MAPPINGS_USED[raw_code_type].add(normalized_code_type)
-                if normalized_code_type not in allowed_code_types:
-                    UNKNOWN_CODE_TYPES[raw_code_type] += 1
-                    continue
-                CODE_TYPE_PRESENCE[normalized_code_type] += 1
-
-                key = (code, normalized_code_type, payer_name, plan_name)
-                payer_row_map[key][mapped_field] = value
-
-        for (code, code_type, payer, plan), field_data in payer_row_map.items():
-            additional_payer_note = field_data.pop("additional notes", "")
-            combined_notes = ", ".join(filter(None, [
-                generic_notes,
-                additional_payer_note
-            ]))
-
-            record = {
-                "hospital name": metadata["hospital_name"],
-                "zip code": metadata["zip_code"],
-                "code": code,
-                "code type": code_type,
-                "insurance payer name": payer,
-                "insurance plan name": plan,
-                "negotiated price": field_data.get("negotiated price", ""),
-                "negotiated percentage": field_data.get("negotiated percentage", ""),
-                "negotiated algorithm": field_data.get("negotiated algorithm", ""),
-                "negotiated methodology": field_data.get("negotiated methodology", ""),
-                "estimated amount": field_data.get("estimated amount", ""),
-                "drug unit": row.get("drug_unit_of_measurement", ""),
-                "drug type": row.get("drug_type_of_measurement", ""),
-                "description": row.get("description", ""),
-                "gross charge": row.get("standard_charge|gross", ""),
-                "discounted cash price": row.get("standard_charge|discounted_cash", ""),
-                "min price": row.get("standard_charge|min", ""),
-                "max price": row.get("standard_charge|max", ""),
-                "setting": row.get("setting", ""),
-                "additional notes": combined_notes,
-                "modifiers": modifiers_raw
-            }
-
-            for k in record:
-                if record[k]:
-                    FIELD_PRESENCE_LOG[k] += 1
-
-            rows.append(record)
-
-    extracted_df = pd.DataFrame(rows, columns=HEADERS)
-    extracted_df.to_csv(output_path, index=False)
-
-    size_mb = os.path.getsize(output_path) / 1024 / 1024
-    logging.info(f"Parsing done. Extracted {len(extracted_df):,} records into '{output_path}' with size: {size_mb:.2f} MB")
-
-    full_field_summary = {field: FIELD_PRESENCE_LOG.get(field, 0) for field in HEADERS}
-    missing_code_types = [ct for ct in allowed_code_types if CODE_TYPE_PRESENCE[ct] == 0]
+    col_to_field = {col: mapped for col in all_columns if (mapped := classify_payer_column(col))}
+    payer_cols = list(col_to_field)
+    col_to_payer_plan = {col: parse_column_for_payer(col)[1:] for col in payer_cols}
+
+    # One entry per payer column: where it sits in the header and which payer/plan/field it holds
+    col_meta = pd.DataFrame(
+        [(col, col_pos, col_to_field[col], *col_to_payer_plan[col])
+         for col_pos, col in enumerate(payer_cols) if col_to_payer_plan[col][0]],
+        columns=["col", "col_pos", "mapped", "payer", "plan"]
+    )
+
+    # Only the fixed columns and mapped payer columns are read
+    read_columns = list(dict.fromkeys(RAW_COLUMNS + col_meta["col"].tolist()))
+
+    written_paths = []
+    total_rows = 0
+    with ExitStack() as stack:
+        out_csv = parquet_writer = None
+        if output_format in ("csv", "both"):
+            out_csv = stack.enter_context(open(output_path, 'w', newline='', encoding='utf-8'))
+            out_csv.write(",".join(HEADERS) + "\n")
+            written_paths.append(output_path)
+        if output_format in ("parquet", "both"):
+            # Written chunk by chunk as row groups, so the full output is never held in memory
+            parquet_writer = stack.enter_context(pq.ParquetWriter(parquet_path, PARQUET_SCHEMA, compression="zstd"))
+            written_paths.append(parquet_path)
+
+        for chunk in read_mrf_csv_chunks(raw_path, header_lines, all_columns, read_columns):
+            out_df = reshape_wide_chunk(chunk, col_meta, metadata, code_type_dtype, code_type_map, stats)
+            if out_csv is not None:
+                out_df.to_csv(out_csv, header=False, index=False)
+            if parquet_writer is not None:
+                parquet_writer.write_table(pa.Table.from_pandas(out_df, schema=PARQUET_SCHEMA, preserve_index=False))
+            total_rows += len(out_df)
+
+    for path in written_paths:
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        logging.info(f"Parsing done. Extracted {total_rows:,} records into '{path}' with size: {size_mb:.2f} MB")
+
+    full_field_summary = {header: int(stats.field_presence[i]) for header, i in HEADER_INDEX.items()}
+    code_type_presence = dict(zip(code_type_dtype.categories, stats.code_type_presence.tolist()))
+    missing_code_types = [ct for ct, count in code_type_presence.items() if count == 0]
 
     devlog = {
         "payer_columns_parsed": len(payer_cols),
-        "total_rows_extracted": len(extracted_df),
+        "total_rows_extracted": total_rows,
         "raw_address_info": {
             "hospital_location": raw_hospital_location,
             "hospital_address": raw_hospital_address
@@ -192,28 +274,43 @@ def extract_wide_format_csv(campus_id, registry_path, config_path, base_dir):
             "last_updated_on": mrf_last_updated
         },
         "field_presence_summary": full_field_summary,
-        "unrecognized_code_types": dict(UNKNOWN_CODE_TYPES),
+        "unrecognized_code_types": dict(stats.unknown_code_types),
         "missing_code_types": missing_code_types,
-        "code_type_presence": dict(CODE_TYPE_PRESENCE),
-        "code_type_normalizations_used": {k: list(v) for k, v in CODE_TYPE_MAPPINGS_USED.items()},
-        "modifier_counts": dict(MODIFIER_COUNTS),
+        "code_type_presence": code_type_presence,
+        "code_type_normalizations_used": {k: list(v) for k, v in stats.code_type_mappings_used.items()},
+        "modifier_counts": dict(stats.modifier_counts),
     }
 
     with open(dev_log_path, "w") as f:
         json.dump(devlog, f, indent=2)
     logging.info(f"Dev log saved to: {dev_log_path}")
 
+def batch_parse(campus_ids, registry_path, config_path, base_dir, workers=None, output_format="csv"):
+    return batch_extract(extract_wide_format_csv, load_registry_info, campus_ids, registry_path, config_path, base_dir,
+                         workers=workers, output_format=output_format)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Clearcare Wide Format CSV Extractor")
-    parser.add_argument("--campus_id", required=True, help="Campus ID as per Hospital Registry")
+    parser.add_argument("--campus_id", required=True, nargs="+", help="Campus ID(s) as per Hospital Registry")
     parser.add_argument("--registry", default="Hospital Registry.xlsx")
     parser.add_argument("--config", default="utils/config.yaml")
     parser.add_argument("--base_dir", default=".")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes when several campus IDs are given")
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, default="csv", help="Write the extract as CSV, zstd Parquet, or both")
     args = parser.parse_args()
 
-    extract_wide_format_csv(
-        campus_id=args.campus_id,
-        registry_path=args.registry,
-        config_path=args.config,
-        base_dir=args.base_dir
-    )
+    if len(args.campus_id) == 1:
+        extract_wide_format_csv(
+            campus_id=args.campus_id[0],
+            registry_path=args.registry,
+            config_path=args.config,
+            base_dir=args.base_dir,
+            output_format=args.output_format
+        )
+    else:
+        results = batch_parse(args.campus_id, args.registry, args.config, args.base_dir, workers=args.workers,
+                              output_format=args.output_format)
+        failed = [campus_id for campus_id, ok in results.items() if not ok]
+        if failed:
+            logging.warning(f"Failed campuses: {', '.join(failed)}")
+        logging.info(f"Batch done: {len(results) - len(failed)}/{len(results)} campuses extracted")